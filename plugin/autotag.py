@@ -3,16 +3,23 @@
 AutoTag.py
 """
 
-from __future__ import print_function
 import sys
 import os
-import fileinput
 import logging
+import mmap
+import shlex
+import shutil
 from collections import defaultdict
+from contextlib import contextmanager
 import subprocess
 from traceback import format_exc
 import multiprocessing as mp
 from glob import glob
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt  # pylint: disable=import-error
 import vim  # pylint: disable=import-error
 
 __all__ = ["autotag"]
@@ -34,33 +41,103 @@ GLOBALS_DEFAULTS = dict(ExcludeSuffixes="tml.xml.text.txt",
                         StopAt=0,
                         StartMethod="")
 
+# (name, kind) -> value, vim_global() results for the current autotag() call
+CONFIG_CACHE = {}
+
+# Seconds the tags worker waits for further saves before updating the tags files
+WORKER_IDLE = 0.5
+
+# Bytes buffered when writing the stripped tags file
+STRIP_BUFFER = 1024 * 1024
+
+# (TagsDir, TagsFile, StopAt) -> {directory: (tags_dir, tags_file)}
+# Remembers which tags file each directory resolved to, for the whole Vim session
+TAGFILE_CACHE = {}
+
 
 def do_cmd(cmd, cwd):
-    """ Abstract subprocess """
-    proc = subprocess.Popen(cmd,
-                            cwd=cwd,
-                            shell=True,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            universal_newlines=True)
-    stdout = proc.communicate()[0]
-    return stdout.split("\n")
+    """ Abstract subprocess, cmd is an argv list (no shell involved).
+        The output is only kept when it'll be logged, it's returned as lines of bytes """
+    if not LOGGER.isEnabledFor(logging.DEBUG):
+        subprocess.run(cmd, cwd=cwd,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        return []
+    proc = subprocess.run(cmd, cwd=cwd,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False)
+    return proc.stdout.split(b"\n")
+
+
+def split_command(cmd):
+    """ Split a command line (e.g. g:autotagCtagsCmd) into an argv list """
+    if os.name != "nt":
+        return shlex.split(cmd)
+    # POSIX rules would eat the backslashes in Windows paths, but non-POSIX shlex
+    # keeps the quotes round "C:\Program Files\..." tokens, so take those off here
+    ret = []
+    for arg in shlex.split(cmd, posix=False):
+        if len(arg) > 1 and arg[0] == arg[-1] and arg[0] in "\"'":
+            arg = arg[1:-1]
+        ret.append(arg)
+    return ret
+
+
+def try_lock(lock_file):
+    """ Take an exclusive lock on an open file without blocking, False if another process has it """
+    try:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def lock(lock_file):
+    """ Take an exclusive lock on an open file, waiting for it """
+    if fcntl:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    else:
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+
+
+def unlock(lock_file):
+    """ Release a lock taken by try_lock() or lock() """
+    if fcntl:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def locked(name):
+    """ Hold the lock on the named lock file, waiting for it """
+    with open(name, "a") as lock_file:
+        lock(lock_file)
+        try:
+            yield
+        finally:
+            unlock(lock_file)
 
 
 def vim_global(name, kind=str):
-    """ Get global variable from vim, cast it appropriately """
+    """ Get global variable from vim, cast it appropriately.
+        Looked up once per autotag() call, CONFIG_CACHE is cleared at the start of each """
+    try:
+        return CONFIG_CACHE[(name, kind)]
+    except KeyError:
+        pass
     ret = GLOBALS_DEFAULTS.get(name, None)
     try:
         vname = "autotag" + name
         v_buffer = "b:" + vname
-        exists_buffer = (vim.eval("exists('%s')" % v_buffer) == "1")
         v_global = "g:" + vname
-        exists_global = (vim.eval("exists('%s')" % v_global) == "1")
-        if exists_buffer:
-            ret = vim.eval(v_buffer)
-        elif exists_global:
-            ret = vim.eval(v_global)
+        (exists_buffer, exists_global, value) = vim.eval(
+            "[exists('%s'), exists('%s'), get(b:, '%s', get(g:, '%s', ''))]"
+            % (v_buffer, v_global, vname, vname))
+        if exists_buffer == "1" or exists_global == "1":
+            ret = value
         else:
             if isinstance(ret, int):
                 vim.command("let %s=%s" % (v_global, ret))
@@ -79,11 +156,33 @@ def vim_global(name, kind=str):
             ret = val
         elif kind == str:
             ret = str(ret)
+    CONFIG_CACHE[(name, kind)] = ret
     return ret
 
 
+def find_python_executable():
+    """ Find the python executable spawned processes should run """
+    suff = os.path.splitext(sys.executable)[1]
+    if sys.platform == "win32":
+        # In Windows pythonw.exe is best, and it's nearly always right here
+        pythonw = os.path.join(sys.exec_prefix, "pythonw%s" % suff)
+        if os.path.isfile(pythonw):
+            return pythonw
+    pat1 = "python*%s" % suff
+    pat2 = os.path.join("bin", pat1)
+    exes = glob(os.path.join(sys.exec_prefix, pat1)) + glob(os.path.join(sys.exec_prefix, pat2))
+    if exes:
+        win = [exe for exe in exes if exe.endswith("w%s" % suff)]
+        if win:
+            return win[0]
+        # This isn't great, for now pick the first one
+        return exes[0]
+    return None
+
+
 def init_multiprocessing():
     """ Init multiprocessing, set_executable() & get the context we'll use """
+    global PYTHON_EXECUTABLE  # pylint: disable=global-statement
     wanted_start_method = vim_global("StartMethod") or None
     used_start_method = mp.get_start_method()
     if wanted_start_method in mp.get_all_start_methods():
@@ -98,23 +197,26 @@ def init_multiprocessing():
     except AttributeError:
         return ret
     if used_start_method == 'spawn':
-        suff = os.path.splitext(sys.executable)[1]
-        pat1 = "python*%s" % suff
-        pat2 = os.path.join("bin", pat1)
-        exes = glob(os.path.join(sys.exec_prefix, pat1)) + glob(os.path.join(sys.exec_prefix, pat2))
-        if exes:
-            win = [exe for exe in exes if exe.endswith("w%s" % suff)]
-            if win:
-                # In Windows pythonw.exe is best
-                ret.set_executable(win[0])
-            else:
-                # This isn't great, for now pick the first one
-                ret.set_executable(exes[0])
+        if PYTHON_EXECUTABLE is None:
+            PYTHON_EXECUTABLE = find_python_executable()
+        if PYTHON_EXECUTABLE:
+            ret.set_executable(PYTHON_EXECUTABLE)
     return ret
 
 
+try:
+    PYTHON_EXECUTABLE
+except NameError:
+    PYTHON_EXECUTABLE = None
+
 CTX = init_multiprocessing()
 
+try:
+    WORKER
+except NameError:
+    WORKER = None
+    WORKER_CONN = None
+
 
 class VimAppendHandler(logging.Handler):
     """ Logger handler that finds a buffer and appends the log message as a new line """
@@ -164,46 +266,59 @@ class AutoTag():  # pylint: disable=too-many-instance-attributes
     FILETYPES = {}
 
     def __init__(self):
-        self.locks = {}
         self.tags = defaultdict(list)
-        self.excludesuffix = ["." + s for s in vim_global("ExcludeSuffixes").split(".")]
+        self.paths = {}
+        self.excludesuffix = tuple("." + s for s in vim_global("ExcludeSuffixes").split("."))
         self.excludefiletype = vim_global("ExcludeFiletypes").split(",")
         set_logger_verbosity()
+        self.verbosity = AutoTag.LOG.level
         self.sep_used_by_ctags = '/'
-        self.ctags_cmd = vim_global("CtagsCmd")
+        # CtagsCmd may carry options too, e.g. "ctags --fields=+l"
+        self.ctags_cmd = split_command(vim_global("CtagsCmd"))
         self.tags_file = str(vim_global("TagsFile"))
         self.tags_dir = str(vim_global("TagsDir"))
-        self.parents = os.pardir * (len(os.path.split(self.tags_dir)) - 1)
+        # how to get from TagsDir back up to the directory it's in, in ctags' separators
+        self.parents = ""
+        if self.tags_dir:
+            parents = os.path.relpath(os.curdir, self.tags_dir)
+            self.parents = parents.replace(os.sep, self.sep_used_by_ctags) + self.sep_used_by_ctags
         self.count = 0
         self.stop_at = vim_global("StopAt")
 
     def find_tag_file(self, source):
         """ Find the tag file that belongs to the source file """
         AutoTag.LOG.info('source = "%s"', source)
+        cache = TAGFILE_CACHE.setdefault((self.tags_dir, self.tags_file, self.stop_at), {})
+        ret = cache.get(os.path.dirname(source))
+        if ret:
+            # Only the tags file itself needs re-checking, not every ancestor
+            if os.path.isfile(ret[1]):
+                AutoTag.LOG.info('cached tags_file "%s"', ret[1])
+                return ret
+            AutoTag.LOG.info('cached tags_file "%s" has gone', ret[1])
+            cache.clear()
         (drive, fname) = os.path.splitdrive(source)
+        visited = []
         ret = None
         while ret is None:
             fname = os.path.dirname(fname)
             AutoTag.LOG.info('drive = "%s", file = "%s"', drive, fname)
             tags_dir = os.path.join(drive, fname)
+            visited.append(tags_dir)
             tags_file = os.path.join(tags_dir, self.tags_dir, self.tags_file)
             AutoTag.LOG.info('testing tags_file "%s"', tags_file)
             if os.path.isfile(tags_file):
-                stinf = os.stat(tags_file)
-                if stinf:
-                    size = getattr(stinf, 'st_size', None)
-                    if size is None:
-                        AutoTag.LOG.warning("Could not stat tags file %s", tags_file)
-                        ret = ""
-                ret = (fname, tags_file)
+                ret = (tags_dir, tags_file)
             elif tags_dir and tags_dir == self.stop_at:
                 AutoTag.LOG.info("Reached %s. Making one %s", self.stop_at, tags_file)
                 open(tags_file, 'wb').close()
-                ret = (fname, tags_file)
-                ret = ""
+                ret = (tags_dir, tags_file)
             elif not fname or fname == os.sep or fname == "//" or fname == "\\\\":
                 AutoTag.LOG.info('bail (file = "%s")', fname)
                 ret = ""
+        if ret:
+            for dname in visited:
+                cache[dname] = ret
         return ret or None
 
     def add_source(self, source, filetype):
@@ -214,6 +329,9 @@ class AutoTag():  # pylint: disable=too-many-instance-attributes
         if os.path.basename(source) == self.tags_file:
             AutoTag.LOG.info("Ignoring tags file %s", self.tags_file)
             return
+        if source.endswith(self.excludesuffix):
+            AutoTag.LOG.info("Ignoring excluded suffix for file %s", source)
+            return
         suff = os.path.splitext(source)[1]
         if suff:
             AutoTag.LOG.info("Source %s has suffix %s, so filetype doesn't count!", source, suff)
@@ -221,50 +339,63 @@ class AutoTag():  # pylint: disable=too-many-instance-attributes
         else:
             AutoTag.LOG.info("Source %s has no suffix, so filetype counts!", source)
 
-        if suff in self.excludesuffix:
-            AutoTag.LOG.info("Ignoring excluded suffix %s for file %s", suff, source)
-            return
         if filetype in self.excludefiletype:
             AutoTag.LOG.info("Ignoring excluded filetype %s for file %s", filetype, source)
             return
         found = self.find_tag_file(source)
         if found:
             (tags_dir, tags_file) = found
-            relative_source = os.path.splitdrive(source)[1][len(tags_dir):]
-            if relative_source[0] == os.sep:
-                relative_source = relative_source[1:]
-            if os.sep != self.sep_used_by_ctags:
-                relative_source = relative_source.replace(os.sep, self.sep_used_by_ctags)
-            key = (tags_dir, tags_file, filetype)
+            relative_source = os.path.relpath(source, tags_dir)
+            relative_source = relative_source.replace(os.sep, self.sep_used_by_ctags)
+            # Normalised so differently cased paths to the same tags file share one update (Windows)
+            key = (os.path.normcase(tags_dir), os.path.normcase(tags_file), filetype)
             self.tags[key].append(relative_source)
-            if key not in self.locks:
-                self.locks[key] = CTX.Lock()
+            self.paths[key] = (tags_dir, tags_file)
 
     @staticmethod
     def good_tag(line, excluded):
-        """ Filter method for stripping tags """
-        if line[0] == '!':
+        """ Filter method for stripping tags, line is raw bytes & excluded a set of bytes """
+        if line[:1] == b'!':
             return True
-        fields = line.split('\t')
-        AutoTag.LOG.log(1, "read tags line:%s", str(fields))
-        if len(fields) > 3 and fields[1] not in excluded:
-            return True
-        return False
+        first = line.find(b'\t')
+        if first < 0:
+            return False
+        second = line.find(b'\t', first + 1)
+        # a tag line has at least four tab separated fields
+        if second < 0 or line.find(b'\t', second + 1) < 0:
+            return False
+        return line[first + 1:second] not in excluded
 
     def strip_tags(self, tags_file, sources):
         """ Strip all tags for a given source file """
         AutoTag.LOG.info("Stripping tags for %s from tags file %s", ",".join(sources), tags_file)
-        backup = ".SAFE"
+        excluded = frozenset(os.fsencode(s) for s in sources)
+        tmp = tags_file + ".tmp"
         try:
-            with fileinput.FileInput(files=tags_file, inplace=True, backup=backup) as source:
-                for line in source:
-                    line = line.strip()
-                    if self.good_tag(line, sources):
-                        print(line)
+            with open(tags_file, "rb") as src, open(tmp, "wb", buffering=STRIP_BUFFER) as dst:
+                with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as tags, \
+                        memoryview(tags) as view:
+                    size = len(tags)
+                    kept = 0  # start of the run of good lines not yet written
+                    start = 0
+                    while start < size:
+                        end = tags.find(b'\n', start)
+                        end = size if end < 0 else end + 1
+                        if not self.good_tag(tags[start:end], excluded):
+                            if kept < start:
+                                dst.write(view[kept:start])
+                            kept = end
+                        start = end
+                    if kept < size:
+                        dst.write(view[kept:size])
+                        if tags[size - 1] != ord(b'\n'):
+                            dst.write(b'\n')
+            shutil.copymode(tags_file, tmp)
+            os.replace(tmp, tags_file)
         finally:
             try:
-                os.unlink(tags_file + backup)
-            except IOError:
+                os.unlink(tmp)
+            except FileNotFoundError:
                 pass
 
     def _vim_ft_to_ctags_ft(self, name):
@@ -273,13 +404,13 @@ class AutoTag():  # pylint: disable=too-many-instance-attributes
             return name
         return self.FILETYPES.get(name, None)
 
-    def update_tags_file(self, key, sources):
-        """ Strip all tags for the source file, then re-run ctags in append mode """
-        (tags_dir, tags_file, filetype) = key
-        lock = self.locks[key]
-        if self.tags_dir:
-            sources = [os.path.join(self.parents + s) for s in sources]
-        cmd = [self.ctags_cmd]
+    def run_ctags(self, tags_dir, tags_file, filetype, sources):
+        """ Strip all tags for the source files, then re-run ctags in append mode """
+        cmd = list(self.ctags_cmd)
+        if not cmd or not shutil.which(cmd[0]):
+            # Don't strip tags that ctags won't be able to put back
+            AutoTag.LOG.warning("Can't find ctags command %s", " ".join(cmd))
+            return
         if self.tags_file:
             cmd += ["-f", self.tags_file]
         if filetype:
@@ -288,34 +419,128 @@ class AutoTag():  # pylint: disable=too-many-instance-attributes
                 cmd += ["--language-force=%s" % ctags_filetype]
         cmd += ["-a"]
 
-        def is_file(src):
-            """ inner """
-            return os.path.isfile(os.path.join(tags_dir, self.tags_dir, src))
-
-        srcs = list(filter(is_file, sources))
+        srcs = [s for s in sources if os.path.isfile(os.path.join(tags_dir, s))]
         if not srcs:
             return
 
-        cmd += ['"%s"' % s for s in srcs]
-        cmd = " ".join(cmd)
-        with lock:
-            self.strip_tags(tags_file, sources)
-            AutoTag.LOG.log(1, "%s: %s", tags_dir, cmd)
-            for line in do_cmd(cmd, self.tags_dir or tags_dir):
-                AutoTag.LOG.log(10, line)
+        if self.tags_dir:
+            # ctags runs in TagsDir, so sources are relative to that
+            sources = [self.parents + s for s in sources]
+            srcs = [self.parents + s for s in srcs]
+        # ctags reads the sources from a file, however many there are
+        file_list = tags_file + ".sources"
+        with open(file_list, "wb") as fobj:
+            fobj.writelines(os.fsencode(s) + b"\n" for s in srcs)
+        cmd += ["-L", file_list]
+        try:
+            if os.stat(tags_file).st_size:
+                self.strip_tags(tags_file, sources)
+            else:
+                AutoTag.LOG.info("Tags file %s is empty, nothing to strip", tags_file)
+            AutoTag.LOG.log(1, "%s: %s %s", tags_dir, cmd, ",".join(srcs))
+            for line in do_cmd(cmd, os.path.join(tags_dir, self.tags_dir)):
+                AutoTag.LOG.log(10, line.decode(errors="replace"))
+        finally:
+            os.unlink(file_list)
+
+    @staticmethod
+    def take_dirty(dirty):
+        """ Claim the sources queued in the dirty file, grouped by filetype """
+        ret = defaultdict(list)
+        # Appends hold the same lock, so none can land in the file once it's been read
+        with locked(dirty + ".lock"):
+            try:
+                with open(dirty, "rb") as fobj:
+                    lines = fobj.readlines()
+            except FileNotFoundError:
+                return ret
+            os.unlink(dirty)
+        for line in lines:
+            (filetype, _, source) = os.fsdecode(line.rstrip(b"\n")).partition("\t")
+            if source not in ret[filetype]:
+                ret[filetype].append(source)
+        return ret
+
+    def update_tags_file(self, key, sources):
+        """ Queue the sources in the tags file's dirty file, then run ctags for everything queued.
+            If another process holds the tags file's lock, leave the queued sources to it """
+        (tags_dir, tags_file) = self.paths[key]
+        filetype = key[2]
+        dirty = tags_file + ".dirty"
+        with locked(dirty + ".lock"), open(dirty, "ab") as fobj:
+            fobj.writelines(os.fsencode("%s\t%s" % (filetype or "", s)) + b"\n" for s in sources)
+        # The holder checks the dirty file again after unlocking, so nothing queued is lost
+        while os.path.exists(dirty):
+            with open(tags_file + ".lock", "a") as lock_file:
+                if not try_lock(lock_file):
+                    AutoTag.LOG.info("%s is locked, leaving %s to its holder",
+                                     tags_file, ",".join(sources))
+                    return
+                try:
+                    for (ftype, queued) in self.take_dirty(dirty).items():
+                        self.run_ctags(tags_dir, tags_file, ftype, queued)
+                finally:
+                    unlock(lock_file)
 
     def rebuild_tag_files(self):
-        """ rebuild the tags file thread worker """
+        """ Hand the sources to the tags worker """
+        if not self.tags:
+            return
         for (key, sources) in self.tags.items():
-            AutoTag.LOG.info('Process(%s, %s)', key, ",".join(sources))
-            proc = CTX.Process(target=self.update_tags_file, args=(key, sources))
-            proc.daemon = True
-            proc.start()
+            AutoTag.LOG.info('Queue(%s, %s)', key, ",".join(sources))
+        worker_connection().send(self)
+
+
+def update_pending(runners, pending):
+    """ Update each tags file the tags worker has gathered sources for """
+    for (key, sources) in pending.items():
+        runner = runners[key]
+        AutoTag.LOG.setLevel(runner.verbosity)
+        try:
+            runner.update_tags_file(key, sorted(sources))
+        except Exception:  # pylint: disable=broad-except
+            AutoTag.LOG.warning(format_exc())
+    runners.clear()
+    pending.clear()
+
+
+def tags_worker(conn):
+    """ Long-lived worker process: gather the sources sent for each tags file
+        and update each tags file once, when no more have arrived for WORKER_IDLE seconds """
+    # A forked worker inherits the sending end too, close it so recv() sees EOF once Vim's gone
+    if WORKER_CONN is not None:
+        WORKER_CONN.close()
+    runners = {}
+    pending = defaultdict(set)
+    while True:
+        try:
+            if pending and not conn.poll(WORKER_IDLE):
+                update_pending(runners, pending)
+                continue
+            runner = conn.recv()
+        except (EOFError, OSError):
+            break
+        for (key, sources) in runner.tags.items():
+            runners[key] = runner
+            pending[key].update(sources)
+    update_pending(runners, pending)
+
+
+def worker_connection():
+    """ The sending end of the pipe to the tags worker, (re)starting the worker if needed """
+    global WORKER, WORKER_CONN  # pylint: disable=global-statement
+    if WORKER is None or not WORKER.is_alive():
+        (reader, WORKER_CONN) = CTX.Pipe(duplex=False)
+        WORKER = CTX.Process(target=tags_worker, args=(reader,))
+        WORKER.daemon = True
+        WORKER.start()
+    return WORKER_CONN
 
 
 def autotag():
     """ Do the work """
     try:
+        CONFIG_CACHE.clear()
         if not vim_global("Disabled", bool):
             runner = AutoTag()
             runner.add_source(vim.eval("expand(\"%:p\")"), vim.eval("&ft"))